@@ -5,151 +5,304 @@
 Post next coupon to Facebook page.
 Designed to be run by GitHub Actions every 2 hours.
 Saves published coupon ids to state.json and commits it back to repo.
+
+Performance notes:
+The run is network-bound; there are no compute-heavy parts here. Critical path
+is 2 HTTPS calls (coupon feed + Graph API post) and 1 git push. Spend effort on
+connection reuse (shared HTTP/2 client, Graph handshake overlapped with the
+fetch), conditional GET (ETag + coupons_cache.json, usually a 304) and fewer
+git subprocesses, not on micro-optimizing the Python code.
 """
 
 import os
 import sys
-import json
+import bisect
+import atexit
+import functools
+import itertools
 import subprocess
-from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from time import sleep
 
-import requests
+import orjson
+import httpx
+import ijson
 from dateutil import parser as date_parser
 
 # Config (can override via env)
 API_URL = os.getenv("COUPONS_API_URL", "https://receivecoupons.com/api/my_api.php?only_active=1&all=1")
 STATE_FILE = os.getenv("STATE_FILE", "state.json")
+COUPONS_CACHE_FILE = os.getenv("COUPONS_CACHE_FILE", "coupons_cache.json")
 FACEBOOK_PAGE_ID = os.getenv("FACEBOOK_PAGE_ID")
 FACEBOOK_ACCESS_TOKEN = os.getenv("FACEBOOK_ACCESS_TOKEN")
 GIT_COMMIT_NAME = "github-actions[bot]"
 GIT_COMMIT_EMAIL = "41898282+github-actions[bot]@users.noreply.github.com"
 
 REQUESTS_TIMEOUT = 15  # seconds
+FEED_RETRIES = 3  # extra attempts for the coupons feed on FEED_RETRY_STATUSES (Graph POSTs are not retried)
+FEED_RETRY_BACKOFF = 0.5  # seconds, doubled after each attempt
+FEED_RETRY_STATUSES = (429, 500, 502, 503, 504)
+# min gap since the last post for workflow re-runs (GITHUB_RUN_ATTEMPT > 1); 0 disables
+MIN_RUN_INTERVAL = timedelta(minutes=int(os.getenv("MIN_RUN_INTERVAL_MINUTES", "90")))
 FACEBOOK_MESSAGE_MAX = 60000  # Facebook allows much longer posts
+_EMPTY = {}  # shared fallback for missing nested dicts; never mutate
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)  # sort key for coupons without dates
 
 if not FACEBOOK_PAGE_ID or not FACEBOOK_ACCESS_TOKEN:
     print("ERROR: FACEBOOK_PAGE_ID and FACEBOOK_ACCESS_TOKEN must be provided in env.", file=sys.stderr)
     sys.exit(2)
 
+# Shared HTTP/2 client so successive calls reuse (and multiplex over) the same TLS connection
+CLIENT = httpx.Client(
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=3,  # connection errors only
+        limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+    ),
+    timeout=REQUESTS_TIMEOUT,
+    follow_redirects=True,
+)
+atexit.register(CLIENT.close)
+
 def load_state(path):
     if not os.path.exists(path):
-        return {"published_ids": [], "last_run": None}
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+        return {"published_ids": [], "last_run": None, "etag": None, "last_modified": None}
+    with open(path, "rb") as f:
+        state = orjson.loads(f.read())
+    state.setdefault("etag", None)
+    state.setdefault("last_modified", None)
+    return state
 
 def save_state(path, state):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(state, option=orjson.OPT_INDENT_2))
+
+def load_coupons_cache(path):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, ValueError) as e:
+        print("Ignoring unreadable coupons cache:", e, file=sys.stderr)
+        return None
 
-def git_commit_and_push(path, message="Update state.json"):
+def save_coupons_cache(path, cache):
+    with open(path, "wb") as f:
+        f.write(orjson.dumps(cache))
+
+def git_commit_and_push(paths, message="Update state.json"):
     try:
-        subprocess.check_call(["git", "config", "user.name", GIT_COMMIT_NAME])
-        subprocess.check_call(["git", "config", "user.email", GIT_COMMIT_EMAIL])
-        subprocess.check_call(["git", "add", path])
-        subprocess.check_call(["git", "commit", "-m", message])
+        # "add" is still needed: commit -a would skip a not-yet-tracked cache file
+        subprocess.check_call(["git", "add", *paths])
+        subprocess.check_call([
+            "git", "-c", f"user.name={GIT_COMMIT_NAME}", "-c", f"user.email={GIT_COMMIT_EMAIL}",
+            "commit", "-m", message,
+        ])
         subprocess.check_call(["git", "push"])
         print("State committed and pushed.")
     except subprocess.CalledProcessError as e:
         print("Git commit/push failed:", e, file=sys.stderr)
 
-def fetch_coupons():
+class _ChunkReader:
+    """Minimal file-like wrapper so ijson can read an httpx byte stream"""
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def read(self, size=-1):
+        # ijson probes the stream type with read(0)
+        return next(self._chunks, b"") if size else b""
+
+def _read_array(events, prefix):
+    """Build the array that just started at prefix, consuming its events"""
+    builder = ijson.ObjectBuilder()
+    builder.event("start_array", None)
+    for current, event, value in events:
+        if current == prefix and event == "end_array":
+            break
+        builder.event(event, value)
+    return builder.value
+
+def iter_coupons(f, backend=ijson):
+    """
+    Stream coupon dicts out of the feed JSON without loading it whole.
+    The feed is either a top-level list, or an object whose "data" list holds
+    the coupons; failing that, its first list value is used. A list seen
+    before "data" is buffered until we know whether "data" follows.
+    backend is an ijson backend module (default: the fastest available).
+    """
+    events = backend.parse(f, use_float=True)
+    fallback = None
+    for prefix, event, _ in events:
+        if event != "start_array" or "." in prefix:
+            continue
+        if prefix == "":
+            yield from backend.items(events, "item")
+            return
+        if prefix == "data":
+            yield from backend.items(events, "data.item")
+            return
+        if fallback is None:
+            fallback = _read_array(events, prefix)
+    if fallback:
+        yield from fallback
+
+def _get_feed(headers, backend):
+    """
+    GET and stream-parse the feed, retrying on FEED_RETRY_STATUSES.
+    Returns (response, entries); entries is None on a 304.
+    """
+    for attempt in itertools.count():
+        with CLIENT.stream("GET", API_URL, headers=headers) as r:
+            if r.status_code not in FEED_RETRY_STATUSES or attempt >= FEED_RETRIES:
+                if r.status_code == 304 and headers:
+                    return r, None
+                r.raise_for_status()
+                return r, prepare_coupons(iter_coupons(_ChunkReader(r.iter_bytes()), backend))
+        delay = FEED_RETRY_BACKOFF * 2 ** attempt
+        print(f"Coupons feed returned {r.status_code}; retrying in {delay}s.", file=sys.stderr)
+        sleep(delay)
+
+def fetch_coupons(state):
+    """
+    Fetch coupons and return (entries, modified), entries prepared as in
+    prepare_coupons. Uses a conditional GET when the local cache is current,
+    so an unchanged feed is neither downloaded nor re-parsed.
+    """
+    cache = load_coupons_cache(COUPONS_CACHE_FILE)
+    etag, last_modified = state.get("etag"), state.get("last_modified")
+    headers = {}
+    # either validator is enough (PHP endpoints often send only Last-Modified)
+    if (cache and (etag or last_modified) and isinstance(cache.get("entries"), list)
+            and cache.get("etag") == etag and cache.get("last_modified") == last_modified):
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
     try:
-        r = requests.get(API_URL, timeout=REQUESTS_TIMEOUT)
-        r.raise_for_status()
-        data = r.json()
-        if isinstance(data, dict):
-            if "data" in data and isinstance(data["data"], list):
-                return data["data"]
-            for v in data.values():
-                if isinstance(v, list):
-                    return v
-            return []
-        elif isinstance(data, list):
-            return data
-        else:
-            return []
+        try:
+            r, entries = _get_feed(headers, ijson)
+        except ijson.IncompleteJSONError as e:
+            # the C backends reject integers wider than 64 bits; the pure-Python
+            # one does not, so re-read the feed with it in that (rare) case
+            if "integer overflow" not in str(e):
+                raise
+            print("Coupons feed has integers too large for the C JSON parser; re-reading it.", file=sys.stderr)
+            r, entries = _get_feed(headers, ijson.get_backend("python"))
+        if entries is None:
+            print("Coupons feed not modified; using cached copy.")
+            return cache["entries"], False
+        state["etag"] = r.headers.get("ETag")
+        state["last_modified"] = r.headers.get("Last-Modified")
+        return entries, True
     except Exception as e:
         print("Failed to fetch coupons:", e, file=sys.stderr)
-        return []
+        return [], False
+
+def _parse_dt(s):
+    """
+    Parse a timestamp string into a tz-aware datetime (naive values are UTC).
+    Returns None if it cannot be parsed. Non-strings (possibly unhashable,
+    e.g. a dict from bad feed data) are rejected before reaching the cache.
+    """
+    if not isinstance(s, str):
+        return None
+    return _parse_dt_str(s)
 
-def is_valid_coupon(coupon):
+@functools.lru_cache(maxsize=1024)
+def _parse_dt_str(s):
+    """Cached part of _parse_dt; failures are memoized as None too"""
     try:
-        if int(coupon.get("is_visible", 0)) != 1:
-            return False
-        expires = coupon.get("expires_at")
-        if not expires:
-            return True
-        dt = date_parser.parse(expires)
-        if dt.tzinfo is None:
-            dt = dt.replace(tzinfo=timezone.utc)
-        return dt > datetime.now(timezone.utc)
-    except Exception as e:
-        print("Error checking coupon expiry:", e, file=sys.stderr)
-        return False
+        # API timestamps are ISO / MySQL format; dateutil is only a fallback
+        dt = datetime.fromisoformat(s.replace("Z", "+00:00"))
+    except ValueError:
+        try:
+            dt = date_parser.parse(s)
+        except (ValueError, OverflowError):
+            return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt
+
+def expiry_timestamp(coupon):
+    """Return coupon expiry as a POSIX timestamp, or None if it never expires"""
+    expires = coupon.get("expires_at")
+    if not expires:
+        return None
+    dt = _parse_dt(expires)
+    if dt is None:
+        raise ValueError(f"unparseable expires_at: {expires!r}")
+    return dt.timestamp()
+
+def is_published(published_ids, cid):
+    """Membership test against the sorted published_ids list"""
+    i = bisect.bisect_left(published_ids, cid)
+    return i < len(published_ids) and published_ids[i] == cid
+
+def cid_of(c):
+    return int(c.get("coupon_id") or c.get("id") or 0)
+
+def sort_key(c):
+    s = c.get("created_at") or c.get("expires_at")
+    if not s:
+        return _EPOCH
+    return _parse_dt(s) or datetime.now(timezone.utc)
+
+def prepare_coupons(coupons):
+    """Visible coupons sorted by created_at, as [expiry_timestamp, coupon] pairs"""
+    entries = []
+    for c in coupons:
+        try:
+            if int(c.get("is_visible", 0)) != 1:
+                continue
+            entries.append([expiry_timestamp(c), c])
+        except Exception as e:
+            print("Error checking coupon expiry:", e, file=sys.stderr)
+    entries.sort(key=lambda entry: sort_key(entry[1]))
+    return entries
+
+# (coupon field, line template) in post order; empty fields are skipped
+MESSAGE_FIELDS = (
+    ("title", "🎉 {}"),                         # العنوان
+    ("discount_text", "🔥 {}"),                 # نص الخصم
+    ("code", "🎁 الكوبون: {}"),                  # الكوبون
+    ("countries", "🌍 صالح لـ: {}"),             # الدول
+    ("note", "📌 ملاحظة: {}"),                   # الملاحظة
+    ("expires_at", "⏳ ينتهي في: {}"),           # تاريخ الانتهاء
+    ("purchase_link", "🛒 رابط الشراء: {}"),     # رابط الشراء
+)
+MESSAGE_FOOTER = "💎 لمزيد من الكوبونات زوروا موقعنا:\nhttps://receivecoupons.com/"
+
+def format_expiry(expires):
+    dt = _parse_dt(expires)
+    return dt.strftime("%d-%m-%Y") if dt else expires
 
 def make_message(c):
     """Create Facebook post message"""
     parts = []
-    
-    # العنوان
-    title = c.get("title") or ""
-    if title:
-        parts.append(f"🎉 {title}")
-        parts.append("")
-    
-    # نص الخصم
-    discount_text = c.get("discount_text") or ""
-    if discount_text:
-        parts.append(f"🔥 {discount_text}")
-        parts.append("")
-    
-    # الكوبون
-    code = c.get("code") or ""
-    if code:
-        parts.append(f"🎁 الكوبون: {code}")
-        parts.append("")
-    
-    # الدول
-    countries = c.get("countries") or ""
-    if countries:
-        parts.append(f"🌍 صالح لـ: {countries}")
-        parts.append("")
-    
-    # الملاحظة
-    note = c.get("note") or ""
-    if note:
-        parts.append(f"📌 ملاحظة: {note}")
-        parts.append("")
-    
-    # تاريخ الانتهاء
-    expires = c.get("expires_at") or ""
-    if expires:
-        try:
-            dt = date_parser.parse(expires)
-            expires_formatted = dt.strftime("%d-%m-%Y")
-        except:
-            expires_formatted = expires
-        parts.append(f"⏳ ينتهي في: {expires_formatted}")
-        parts.append("")
-    
-    # رابط الشراء
-    link = c.get("purchase_link") or ""
-    if link:
-        parts.append(f"🛒 رابط الشراء: {link}")
-        parts.append("")
-    
-    # رابط الموقع
-    parts.append("💎 لمزيد من الكوبونات زوروا موقعنا:")
-    parts.append("https://receivecoupons.com/")
-    
-    message = "\n".join(parts).strip()
+    for key, fmt in MESSAGE_FIELDS:
+        val = c.get(key)
+        if val:
+            if key == "expires_at":
+                val = format_expiry(val)
+            parts.append(fmt.format(val))
+    parts.append(MESSAGE_FOOTER)
+
+    message = "\n\n".join(parts).strip()
 
     # truncate if too long
     if len(message) > FACEBOOK_MESSAGE_MAX:
         message = message[: FACEBOOK_MESSAGE_MAX - 3] + "..."
     return message
 
+def warm_up_graph_connection():
+    """Open the TLS connection to graph.facebook.com ahead of the post"""
+    try:
+        CLIENT.head("https://graph.facebook.com/")
+    except httpx.HTTPError as e:
+        print("Graph API warm-up failed (ignored):", e, file=sys.stderr)
+
 def post_to_facebook_with_photo(photo_url, message):
     """Post to Facebook page with photo"""
     url = f"https://graph.facebook.com/v21.0/{FACEBOOK_PAGE_ID}/photos"
@@ -161,13 +314,15 @@ def post_to_facebook_with_photo(photo_url, message):
     }
     
     try:
-        r = requests.post(url, data=payload, timeout=REQUESTS_TIMEOUT)
+        r = CLIENT.post(url, data=payload)
         r.raise_for_status()
         return r.json()
-    except Exception as e:
+    except httpx.HTTPStatusError as e:
+        print("Failed to post photo to Facebook:", e, file=sys.stderr)
+        print("Response:", e.response.text, file=sys.stderr)
+        return None
+    except (httpx.HTTPError, ValueError) as e:
         print("Failed to post photo to Facebook:", e, file=sys.stderr)
-        if hasattr(e, 'response') and e.response is not None:
-            print("Response:", e.response.text, file=sys.stderr)
         return None
 
 def post_to_facebook_text_only(message):
@@ -180,60 +335,71 @@ def post_to_facebook_text_only(message):
     }
     
     try:
-        r = requests.post(url, data=payload, timeout=REQUESTS_TIMEOUT)
+        r = CLIENT.post(url, data=payload)
         r.raise_for_status()
         return r.json()
-    except Exception as e:
+    except httpx.HTTPStatusError as e:
+        print("Failed to post to Facebook:", e, file=sys.stderr)
+        print("Response:", e.response.text, file=sys.stderr)
+        return None
+    except (httpx.HTTPError, ValueError) as e:
         print("Failed to post to Facebook:", e, file=sys.stderr)
-        if hasattr(e, 'response') and e.response is not None:
-            print("Response:", e.response.text, file=sys.stderr)
         return None
 
 def main():
     state = load_state(STATE_FILE)
-    published_ids = set(state.get("published_ids", []))
 
-    coupons = fetch_coupons()
-    if not coupons:
+    # skip the fetch entirely when a re-run of a workflow (scheduled or manual)
+    # follows a recent post. First attempts are never gated: scheduled runs
+    # often start late, and a workflow_dispatch is a deliberate request to post.
+    last_run = state.get("last_run")
+    last_run_dt = _parse_dt(last_run) if last_run else None
+    if (last_run_dt and MIN_RUN_INTERVAL and os.getenv("GITHUB_RUN_ATTEMPT", "1") != "1"
+            and datetime.now(timezone.utc) - last_run_dt < MIN_RUN_INTERVAL):
+        print(f"Last post was at {last_run}, less than {MIN_RUN_INTERVAL} ago. Exiting.")
+        sys.exit(0)
+
+    # membership is a bisect and updates are an insort; sort once in case
+    # state.json was edited or merged by hand (O(n) when already sorted)
+    published_ids = state.setdefault("published_ids", [])
+    published_ids.sort()
+
+    # the coupon fetch and the Graph API handshake are independent, so overlap them
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        fut_entries = ex.submit(fetch_coupons, state)
+        ex.submit(warm_up_graph_connection)
+        entries, feed_modified = fut_entries.result()
+    if not entries:
         print("No coupons fetched. Exiting.")
         sys.exit(0)
 
-    # keep only valid coupons
-    valid = [c for c in coupons if is_valid_coupon(c)]
-    if not valid:
+    # entries are already sorted by created_at; walk the non-expired ones lazily
+    # and stop at the first unposted coupon instead of filtering the whole list
+    now_ts = datetime.now(timezone.utc).timestamp()
+    valid = (c for expires_ts, c in entries if expires_ts is None or expires_ts > now_ts)
+    first_valid = next(valid, None)
+    if first_valid is None:
         print("No valid (visible and not expired) coupons found.")
         sys.exit(0)
 
-    # Sort by created_at
-    def sort_key(c):
-        try:
-            return date_parser.parse(c.get("created_at") or c.get("expires_at") or "1970-01-01")
-        except:
-            return datetime.now(timezone.utc)
-
-    valid_sorted = sorted(valid, key=sort_key)
-
-    # find next unposted coupon
-    next_coupon = None
-    for c in valid_sorted:
-        cid = int(c.get("coupon_id") or c.get("id") or 0)
-        if cid not in published_ids:
-            next_coupon = c
-            break
+    # find next unposted coupon (oldest first)
+    next_coupon = next(
+        (c for c in itertools.chain((first_valid,), valid) if not is_published(published_ids, cid_of(c))),
+        None,
+    )
 
     # If all coupons published, reset and start over
     if next_coupon is None:
         print("All coupons already published. Resetting published list and selecting first coupon.")
-        published_ids = set()
-        state["published_ids"] = []
-        next_coupon = valid_sorted[0]
+        published_ids = state["published_ids"] = []
+        next_coupon = first_valid
 
     if not next_coupon:
         print("No coupon to post. Exiting.")
         sys.exit(0)
 
     # Get photo URL from store logo or direct logo_url
-    photo_url = next_coupon.get("store", {}).get("logo_url") or next_coupon.get("logo_url") or ""
+    photo_url = (next_coupon.get("store") or _EMPTY).get("logo_url") or next_coupon.get("logo_url") or ""
     message = make_message(next_coupon)
 
     # Post to Facebook
@@ -245,16 +411,30 @@ def main():
     if resp and ("id" in resp or "post_id" in resp):
         # mark as published
         try:
-            cid = int(next_coupon.get("coupon_id") or next_coupon.get("id") or 0)
-            published_ids.add(cid)
-            state["published_ids"] = sorted(list(published_ids))
+            cid = cid_of(next_coupon)
+            if not is_published(published_ids, cid):
+                bisect.insort(published_ids, cid)
             state["last_run"] = datetime.now(timezone.utc).isoformat()
             save_state(STATE_FILE, state)
             print(f"Posted coupon {cid} successfully to Facebook.")
-            # commit state file back to repo
-            git_commit_and_push(STATE_FILE, message=f"chore: mark coupon {cid} as published")
         except Exception as e:
             print("Failed updating state after post:", e, file=sys.stderr)
+            return
+
+        # commit state (and the cache, only when the feed changed) back to repo;
+        # the cache is optional, so failing to write it must not block the push
+        paths = [STATE_FILE]
+        if feed_modified and (state["etag"] or state["last_modified"]):
+            try:
+                save_coupons_cache(COUPONS_CACHE_FILE, {
+                    "etag": state["etag"],
+                    "last_modified": state["last_modified"],
+                    "entries": entries,
+                })
+                paths.append(COUPONS_CACHE_FILE)
+            except (OSError, TypeError) as e:
+                print("Failed writing coupons cache (skipped):", e, file=sys.stderr)
+        git_commit_and_push(paths, message=f"chore: mark coupon {cid} as published")
     else:
         print("Facebook API did not return success. Response:", resp, file=sys.stderr)
         sys.exit(1)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# post_to_facebook exits at import time without these
+os.environ.setdefault("FACEBOOK_PAGE_ID", "test")
+os.environ.setdefault("FACEBOOK_ACCESS_TOKEN", "test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
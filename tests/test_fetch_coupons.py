@@ -0,0 +1,109 @@
+import json
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+import post_to_facebook as pf
+
+FEED = {"data": [{"id": 1, "is_visible": 1, "created_at": "2025-01-01 00:00:00"}]}
+ENTRIES = [[None, FEED["data"][0]]]
+
+
+@pytest.fixture
+def feed(monkeypatch, tmp_path):
+    """Route CLIENT through a MockTransport serving feed.responses in order"""
+    feed = SimpleNamespace(requests=[], responses=[])
+
+    def handler(request):
+        feed.requests.append(request)
+        return feed.responses.pop(0)
+
+    monkeypatch.setattr(pf, "CLIENT", httpx.Client(transport=httpx.MockTransport(handler)))
+    monkeypatch.setattr(pf, "COUPONS_CACHE_FILE", str(tmp_path / "coupons_cache.json"))
+    monkeypatch.setattr(pf, "sleep", lambda delay: None)
+    return feed
+
+
+def write_cache(etag, entries=ENTRIES):
+    pf.save_coupons_cache(pf.COUPONS_CACHE_FILE, {"etag": etag, "last_modified": None, "entries": entries})
+
+
+def test_200_stores_validators(feed):
+    feed.responses.append(httpx.Response(200, json=FEED, headers={"ETag": '"v1"', "Last-Modified": "LM"}))
+    state = {}
+    assert pf.fetch_coupons(state) == (ENTRIES, True)
+    assert state["etag"] == '"v1"'
+    assert state["last_modified"] == "LM"
+    assert "if-none-match" not in feed.requests[0].headers
+
+
+def test_304_served_from_cache(feed):
+    write_cache('"v1"')
+    feed.responses.append(httpx.Response(304))
+    state = {"etag": '"v1"', "last_modified": None}
+    assert pf.fetch_coupons(state) == (ENTRIES, False)
+    assert feed.requests[0].headers["if-none-match"] == '"v1"'
+
+
+def test_304_with_stale_cache_fails(feed):
+    write_cache('"old"')
+    feed.responses.append(httpx.Response(304))
+    state = {"etag": '"v1"', "last_modified": None}
+    assert pf.fetch_coupons(state) == ([], False)
+    assert "if-none-match" not in feed.requests[0].headers
+
+
+def test_5xx_then_success(feed, monkeypatch):
+    delays = []
+    monkeypatch.setattr(pf, "sleep", delays.append)
+    feed.responses.extend([httpx.Response(503), httpx.Response(200, json=FEED)])
+    assert pf.fetch_coupons({}) == (ENTRIES, True)
+    assert delays == [pf.FEED_RETRY_BACKOFF]
+
+
+def test_retries_run_out(feed):
+    feed.responses.extend(httpx.Response(503) for _ in range(pf.FEED_RETRIES + 1))
+    assert pf.fetch_coupons({}) == ([], False)
+    assert len(feed.requests) == pf.FEED_RETRIES + 1
+
+
+@pytest.mark.parametrize("attempt, fetched", [("2", False), ("1", True)])
+def test_min_interval_gate(feed, monkeypatch, tmp_path, attempt, fetched):
+    state_file = tmp_path / "state.json"
+    state_file.write_text(json.dumps({
+        "published_ids": [],
+        "last_run": datetime.now(timezone.utc).isoformat(),
+    }))
+    monkeypatch.setattr(pf, "STATE_FILE", str(state_file))
+    monkeypatch.setattr(pf, "warm_up_graph_connection", lambda: None)
+    monkeypatch.setenv("GITHUB_RUN_ATTEMPT", attempt)
+    feed.responses.append(httpx.Response(200, json={"data": []}))
+    with pytest.raises(SystemExit) as exc:
+        pf.main()
+    assert exc.value.code == 0
+    assert bool(feed.requests) is fetched
+
+
+def test_cache_write_failure_still_pushes_state(feed, monkeypatch, tmp_path):
+    state_file = tmp_path / "state.json"
+    monkeypatch.setattr(pf, "STATE_FILE", str(state_file))
+    monkeypatch.setattr(pf, "COUPONS_CACHE_FILE", str(tmp_path / "missing" / "coupons_cache.json"))
+    monkeypatch.setattr(pf, "warm_up_graph_connection", lambda: None)
+    monkeypatch.setattr(pf, "post_to_facebook_text_only", lambda message: {"id": "post"})
+    pushed = []
+    monkeypatch.setattr(pf, "git_commit_and_push", lambda paths, message: pushed.append(paths))
+    feed.responses.append(httpx.Response(200, json=FEED, headers={"ETag": '"v1"'}))
+    pf.main()
+    assert pushed == [[str(state_file)]]
+    assert json.loads(state_file.read_text())["published_ids"] == [1]
+
+
+def test_big_integers_fall_back_to_python_backend(feed):
+    body = b'{"data": [{"id": 1, "is_visible": 1, "ref": 1180591620717411303424}]}'
+    feed.responses.extend([httpx.Response(200, content=body), httpx.Response(200, content=body)])
+    entries, modified = pf.fetch_coupons({})
+    assert modified
+    assert entries == [[None, {"id": 1, "is_visible": 1, "ref": 2 ** 70}]]
+    assert len(feed.requests) == 2
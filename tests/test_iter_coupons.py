@@ -0,0 +1,31 @@
+import io
+import json
+
+import pytest
+
+from post_to_facebook import iter_coupons
+
+
+def coupons_from(doc):
+    return list(iter_coupons(io.BytesIO(json.dumps(doc).encode("utf-8"))))
+
+
+@pytest.mark.parametrize("doc, expected", [
+    # "data" wins even when another list comes first
+    ({"errors": [], "data": [{"id": 4}]}, [{"id": 4}]),
+    ({"errors": [{"code": 1}], "data": [{"id": 4}], "more": [{"id": 9}]}, [{"id": 4}]),
+    # no "data" list: first top-level list value
+    ({"meta": {"ids": [1]}, "items": [{"id": 5}], "other": [{"id": 6}]}, [{"id": 5}]),
+    ({"errors": [{"code": 1}], "data": {"count": 0}}, [{"code": 1}]),
+    # top-level list
+    ([{"id": 1}, {"id": 2}], [{"id": 1}, {"id": 2}]),
+    # no list at all
+    ({"status": "ok"}, []),
+])
+def test_feed_shapes(doc, expected):
+    assert coupons_from(doc) == expected
+
+
+def test_floats_are_not_decimals():
+    (coupon,) = coupons_from({"data": [{"id": 1, "price": 1.5}]})
+    assert type(coupon["price"]) is float